@@ -1,11 +1,28 @@
 import streamlit as st
 import joblib
+import numpy as np
 import pandas as pd
 import requests
 import json
+import atexit
+import glob
+import os
+import queue
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from math import ceil
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
 # Configure page
 st.set_page_config(
     page_title="Solar Radiation Prediction App",
@@ -35,13 +52,6 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-# Load model globally (used by multiple pages)
-knn_path = "knn.pkl"  # Path to the trained KNN.pkl model
-try:
-    knn = joblib.load(knn_path)
-except Exception as e:
-    knn = None
-    st.error(f"Failed to load model: {e}")
 
 # Average retail electricity rates ($/kWh) by country — IEA / GlobalPetrolPrices 2024
 ELECTRICITY_RATES = {
@@ -55,6 +65,15 @@ ELECTRICITY_RATES = {
 }
 DEFAULT_RATE = 0.15  # fallback when country unknown
 
+PANEL_BRANDS = [
+    {"Brand": "SunPower",      "Efficiency (%)": 22.8, "Area (m²)": 1.63, "Nominal Power (W)": 430},
+    {"Brand": "LG",            "Efficiency (%)": 20.4, "Area (m²)": 1.70, "Nominal Power (W)": 400},
+    {"Brand": "Panasonic",     "Efficiency (%)": 20.3, "Area (m²)": 1.70, "Nominal Power (W)": 405},
+    {"Brand": "Jinko (Generic)","Efficiency (%)": 18.4, "Area (m²)": 1.70, "Nominal Power (W)": 375},
+    {"Brand": "Custom",        "Efficiency (%)": None,  "Area (m²)": None,  "Nominal Power (W)": None},
+]
+DEFAULT_DERATE = 0.77
+
 # City database with population data (sorted by population)
 MAJOR_CITIES = [
     {"name": "Tokyo",           "lat": 35.6762,  "lon": 139.6503,  "population": 37400068, "country": "Japan"},
@@ -138,7 +157,7 @@ def fetch_weather_data(lat, lon, city_name):
     weather_api_url = f"https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={api_key}"
     
     try:
-        response = requests.get(weather_api_url)
+        response = requests.get(weather_api_url, timeout=10)
         if response.status_code == 200:
             return response.json()
     except Exception as e:
@@ -164,6 +183,729 @@ def get_local_hour(timezone_offset):
     return datetime.now().hour
 
 
+# ============== MODEL STORE ==============
+# The deployed model is the frozen `knn.pkl` plus any published versions in
+# MODEL_DIR. Each version is an immutable bundle: a reference to the KD-tree
+# base model file and a small "delta" of samples added since that tree was
+# built. The delta gets its own small KD-tree and the two top-k lists are
+# merged, so adding measurements never rebuilds the base; once the delta
+# outgrows COMPACT_THRESHOLD it is folded into a new base file on the next
+# publish. Only the current and previous versions are kept on disk.
+knn_path = "knn.pkl"  # Path to the trained KNN.pkl model (version 0)
+MODEL_DIR = "models"
+CURRENT_POINTER = os.path.join(MODEL_DIR, "CURRENT")
+TRAINING_STORE_PATH = "training_samples.csv"  # append-only ground truth log
+FEATURE_NAMES = ['Hour', 'Temperature', 'Dew Point', 'Relative Humidity', 'Surface Albedo', 'Pressure', 'Wind Speed']
+TARGET_NAME = "GHI"
+COMPACT_THRESHOLD = 5000   # delta rows before the KD-tree is rebuilt
+UNCERTAINTY_SCALE_SAMPLE = 1000  # training rows used to calibrate confidence
+PREDICTION_CACHE_SIZE = 1024      # memoized single-row predictions per version
+
+PUBLISH_LOCK_PATH = os.path.join(MODEL_DIR, ".publish.lock")
+
+
+class IncrementalKNN:
+    """Read-only view of one model version: base KNN + appended samples."""
+
+    def __init__(self, base, delta_X=None, delta_y=None, version=0, base_file=knn_path):
+        self.base = base
+        self.base_file = base_file  # None until a freshly compacted base is saved
+        self.version = version
+        self.n_neighbors = base.n_neighbors
+        self.weights = base.weights
+        self._distance_scale = None
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        n_features = len(FEATURE_NAMES)
+        self.delta_X = (np.empty((0, n_features)) if delta_X is None
+                        else np.asarray(delta_X, dtype=float))
+        self.delta_y = (np.empty(0) if delta_y is None
+                        else np.asarray(delta_y, dtype=float))
+        self._delta_tree = None
+        if self.n_delta:
+            from sklearn.neighbors import KDTree
+
+            self._delta_tree = KDTree(self.delta_X, metric=base.effective_metric_,
+                                      **base.effective_metric_params_)
+
+    @property
+    def n_base(self):
+        return self.base.n_samples_fit_
+
+    @property
+    def n_delta(self):
+        return len(self.delta_y)
+
+    def _as_array(self, X):
+        if isinstance(X, pd.DataFrame):
+            X = X[FEATURE_NAMES].values
+        return np.asarray(X, dtype=float)
+
+    def kneighbors_targets(self, X):
+        """Return (distances, target values) of the k nearest samples.
+
+        Both arrays have shape (n_rows, k) and are sorted by distance.
+        """
+        X = self._as_array(X)
+        k = self.n_neighbors
+        dist, ind = self.base.kneighbors(pd.DataFrame(X, columns=FEATURE_NAMES), n_neighbors=k)
+        targets = np.asarray(self.base._y, dtype=float).ravel()[ind]
+        if self.n_delta == 0:
+            return dist, targets
+
+        # Merge the base tree's top-k with the delta tree's: (n_rows x 2k).
+        d_delta, i_delta = self._delta_tree.query(X, k=min(k, self.n_delta))
+        d_all = np.hstack([dist, d_delta])
+        y_all = np.hstack([targets, self.delta_y[i_delta]])
+        order = np.argsort(d_all, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(d_all, order, axis=1), np.take_along_axis(y_all, order, axis=1)
+
+    def _mean(self, dist, targets):
+        if self.weights == "distance":
+            with np.errstate(divide="ignore"):
+                w = 1.0 / dist
+            # Exact matches dominate, as in scikit-learn.
+            exact = np.isinf(w)
+            w = np.where(exact.any(axis=1, keepdims=True), exact.astype(float), w)
+            return (w * targets).sum(axis=1) / w.sum(axis=1)
+        return targets.mean(axis=1)
+
+    def predict(self, X):
+        return self._mean(*self.kneighbors_targets(X))
+
+    def distance_scale(self):
+        """Typical k-neighbour distance within the training data.
+
+        Computed once per model version from a sample of indexed points and
+        used to turn query distances into a 0–1 confidence score.
+        """
+        if self._distance_scale is None:
+            fit_X = np.asarray(self.base._fit_X, dtype=float)
+            rng = np.random.default_rng(0)
+            sample = fit_X[rng.choice(len(fit_X), min(len(fit_X), UNCERTAINTY_SCALE_SAMPLE), replace=False)]
+            # k + 1 neighbours because each sampled point finds itself first.
+            dist, _ = self.base.kneighbors(pd.DataFrame(sample, columns=FEATURE_NAMES),
+                                           n_neighbors=min(self.n_neighbors + 1, len(fit_X)))
+            self._distance_scale = float(np.median(dist[:, 1:].mean(axis=1))) or 1.0
+        return self._distance_scale
+
+    def predict_with_uncertainty(self, X, interval=(10, 90)):
+        """Predict GHI with neighbour spread from the same kneighbors query.
+
+        Returns a DataFrame with one row per input row: the prediction, the
+        standard deviation and percentile interval of the neighbours' GHI, and
+        a confidence score that is 1 for an exact match and 0.5 when the
+        neighbours are as far away as is typical in the training data.
+        """
+        dist, targets = self.kneighbors_targets(X)
+        low, high = np.percentile(targets, interval, axis=1)
+        confidence = np.exp(-np.log(2) * dist.mean(axis=1) / self.distance_scale())
+        return pd.DataFrame({
+            "GHI": self._mean(dist, targets),
+            "GHI Std": targets.std(axis=1),
+            f"GHI P{interval[0]}": low,
+            f"GHI P{interval[1]}": high,
+            "Confidence": confidence,
+        })
+
+    def predict_one(self, features):
+        """Uncertainty prediction for one {feature: value} row.
+
+        Memoized per model version (LRU); returns (result dict, cache_hit).
+        """
+        key = tuple(float(features[name]) for name in FEATURE_NAMES)
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key], True
+        result = self.predict_with_uncertainty(np.array([key])).iloc[0].to_dict()
+        with self._cache_lock:
+            self._cache[key] = result
+            if len(self._cache) > PREDICTION_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return result, False
+
+    def with_samples(self, X, y):
+        """Return a new version with (X, y) appended; self is left untouched."""
+        delta_X = np.vstack([self.delta_X, self._as_array(X)])
+        delta_y = np.concatenate([self.delta_y, np.asarray(y, dtype=float)])
+        if len(delta_y) < COMPACT_THRESHOLD:
+            return IncrementalKNN(self.base, delta_X, delta_y, self.version + 1, self.base_file)
+
+        from sklearn.base import clone
+
+        all_X = np.vstack([np.asarray(self.base._fit_X, dtype=float), delta_X])
+        all_y = np.concatenate([np.asarray(self.base._y, dtype=float).ravel(), delta_y])
+        base = clone(self.base).fit(pd.DataFrame(all_X, columns=FEATURE_NAMES), all_y)
+        return IncrementalKNN(base, version=self.version + 1, base_file=None)
+
+    def to_bundle(self):
+        return {
+            "version": self.version, "base_file": self.base_file,
+            "delta_X": self.delta_X, "delta_y": self.delta_y,
+            "created": datetime.utcnow().isoformat(),
+        }
+
+
+def _atomic_replace(path, write):
+    """Write `path` through a temp file in the same directory + os.replace.
+
+    Readers see either the old file or the complete new one, never a
+    partially written file.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def current_model_path():
+    """Path of the published model version, falling back to knn.pkl."""
+    try:
+        with open(CURRENT_POINTER) as f:
+            name = f.read().strip()
+        if name:
+            return os.path.join(MODEL_DIR, name)
+    except OSError:
+        pass
+    return knn_path
+
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def _load_base(path, mtime_ns):
+    return joblib.load(path)
+
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def _load_model(path, mtime_ns):
+    if path == knn_path:
+        return IncrementalKNN(_load_base(path, mtime_ns))
+    bundle = joblib.load(path)
+    base_file = bundle["base_file"]
+    base = _load_base(base_file, os.stat(base_file).st_mtime_ns)
+    return IncrementalKNN(base, bundle["delta_X"], bundle["delta_y"], bundle["version"], base_file)
+
+
+def load_current_model():
+    """Load the latest published model, cached per (path, mtime).
+
+    Called on every rerun, so a newly published version is picked up
+    without restarting; a rerun already holding the old object keeps it.
+    """
+    path = current_model_path()
+    return _load_model(path, os.stat(path).st_mtime_ns)
+
+
+def append_training_samples(samples):
+    """Append ground-truth rows to the training store (never rewritten)."""
+    samples = samples[FEATURE_NAMES + [TARGET_NAME]]
+    write_header = not os.path.exists(TRAINING_STORE_PATH)
+    samples.to_csv(TRAINING_STORE_PATH, mode="a", header=write_header, index=False)
+
+
+@contextmanager
+def _publish_lock():
+    """Cross-process lock around read → build → write → swap of a version.
+
+    An OS-level lock on a persistent file: released automatically if the
+    holder dies, and never removed, so no process can delete another's lock.
+    """
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    with open(PUBLISH_LOCK_PATH, "a+") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:  # LK_LOCK gives up after ~10 s; keep waiting
+                    continue
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _version_name(version):
+    return f"knn-v{version:05d}.joblib"
+
+
+def _prune_versions(keep):
+    """Delete version and base files not used by the models in `keep`."""
+    keep_names = {_version_name(m.version) for m in keep}
+    keep_names |= {os.path.basename(m.base_file) for m in keep if m.base_file != knn_path}
+    for path in glob.glob(os.path.join(MODEL_DIR, "knn-*.joblib")):
+        if os.path.basename(path) not in keep_names:
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # e.g. still open on Windows; retried on the next publish
+
+
+def publish_samples(samples):
+    """Publish a model version that includes `samples`, then record them.
+
+    Samples are validated and the version is written and made current
+    before anything is appended to the store, so the store never holds
+    rows that no published model contains. The base KD-tree is only
+    written when the delta was compacted into a new one.
+    """
+    samples = samples[FEATURE_NAMES + [TARGET_NAME]].apply(pd.to_numeric, errors="raise")
+    if samples.isna().any().any():
+        raise ValueError("Samples contain missing values.")
+    with _publish_lock():
+        previous = load_current_model()
+        model = previous.with_samples(samples[FEATURE_NAMES], samples[TARGET_NAME])
+        if model.base_file is None:
+            model.base_file = os.path.join(MODEL_DIR, f"knn-base-v{model.version:05d}.joblib")
+            _atomic_replace(model.base_file, lambda f: joblib.dump(model.base, f))
+        name = _version_name(model.version)
+        _atomic_replace(os.path.join(MODEL_DIR, name),
+                        lambda f: joblib.dump(model.to_bundle(), f))
+        _atomic_replace(CURRENT_POINTER, lambda f: f.write(name.encode()))
+        append_training_samples(samples)
+        _prune_versions(keep=(previous, model))
+    return model
+
+
+# Load model globally (used by multiple pages)
+try:
+    knn = load_current_model()
+except Exception as e:
+    knn = None
+    st.error(f"Failed to load model: {e}")
+
+
+# ============== TARIFFS ==============
+# Tariffs are compiled into dense arrays so a fleet of sites is billed with a
+# handful of NumPy operations: per-hour energy rates (tariff x weekend x hour)
+# plus optional monthly tiers priced on top. Hourly profiles cover one
+# 365-day year starting on a Wednesday (as 2025 does).
+TARIFFS_PATH = "tariffs.json"
+TARIFF_CHUNK_SITES = 250  # sites billed per block (~17 MB per 8760-hour array)
+
+_MONTH_DAYS = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+_DAY_OF_YEAR = np.repeat(np.arange(365), 24)
+_HOUR_OF_DAY = np.tile(np.arange(24), 365)
+_IS_WEEKEND = ((_DAY_OF_YEAR + 2) % 7 >= 5).astype(int)  # Jan 1 = Wednesday
+_MONTH_STARTS = np.concatenate([[0], np.cumsum(_MONTH_DAYS)[:-1]]) * 24
+
+
+class TariffBook:
+    """Indexed set of tariffs compiled to arrays for vectorized billing."""
+
+    def __init__(self, tariffs):
+        n = len(tariffs)
+        n_tiers = max([len(t.get("tiers") or []) for t in tariffs] + [1])
+        self.meta = pd.DataFrame(
+            [{k: t.get(k, "") for k in ("id", "country", "utility", "name")} for t in tariffs]
+        )
+        self.index = {t["id"]: i for i, t in enumerate(tariffs)}
+        self.by_country = {}
+        for i, t in enumerate(tariffs):
+            self.by_country.setdefault(t.get("country", ""), []).append(i)
+
+        self.hour_rates = np.zeros((n, 2, 24))  # [tariff, weekend, hour]
+        self.tier_limits = np.full((n, n_tiers), np.inf)  # cumulative monthly kWh
+        self.tier_rates = np.zeros((n, n_tiers))
+        self.fixed_monthly = np.zeros(n)
+        for i, t in enumerate(tariffs):
+            self.hour_rates[i] = t.get("base_rate", 0.0)
+            # Later bands override earlier ones where they overlap.
+            for band in t.get("tou") or []:
+                start, end = band["start_hour"], band["end_hour"]
+                hours = np.arange(start, end if end > start else end + 24) % 24
+                days = {"weekday": [0], "weekend": [1]}.get(band.get("days", "all"), [0, 1])
+                self.hour_rates[np.ix_([i], days, hours)] = band["rate"]
+            for j, tier in enumerate(t.get("tiers") or []):
+                limit = tier.get("up_to_kwh")
+                self.tier_limits[i, j] = np.inf if limit is None else limit
+                self.tier_rates[i, j] = tier["rate"]
+            self.fixed_monthly[i] = t.get("fixed_monthly", 0.0)
+
+    def __len__(self):
+        return len(self.index)
+
+    def label(self, row):
+        t = self.meta.iloc[row]
+        return f"{t['utility']} {t['name']}".strip()
+
+    def default_row(self, country):
+        """Row of the flat country-average tariff (DEFAULT_RATE if unknown)."""
+        return self.index.get(f"avg-{country}", self.index["avg-default"])
+
+    def _tier_costs(self, rows, monthly):
+        """Annual tiered charge for (n_sites, 12) monthly kWh."""
+        upper = self.tier_limits[rows][:, None, :]
+        lower = np.concatenate([np.zeros_like(upper[..., :1]), upper[..., :-1]], axis=-1)
+        in_tier = np.clip(np.minimum(monthly[..., None], upper) - lower, 0, None)
+        return (in_tier * self.tier_rates[rows][:, None, :]).sum(axis=(1, 2))
+
+    def annual_bills(self, rows, import_kwh):
+        """Annual bill for each row of an (n_sites, 8760) grid-import matrix."""
+        rows = np.asarray(rows)
+        rates = self.hour_rates[rows[:, None], _IS_WEEKEND, _HOUR_OF_DAY]
+        energy = (rates * import_kwh).sum(axis=1)
+        monthly = np.add.reduceat(import_kwh, _MONTH_STARTS, axis=1)  # (n, 12)
+        return energy + self._tier_costs(rows, monthly) + 12 * self.fixed_monthly[rows]
+
+    def is_tiered(self, row):
+        return bool(np.isfinite(self.tier_limits[row]).any())
+
+    def annual_savings(self, rows, annual_kwh, lat, monthly_load_kwh=None):
+        """Bill reduction from solar generation, for many sites at once.
+
+        Each site's hourly profile is built from `annual_kwh` and `lat` one
+        block of TARIFF_CHUNK_SITES at a time, so memory stays bounded for
+        any fleet size. Generation is net metered: every kWh is credited at
+        its hour's energy rate, and tiers are billed on monthly net import,
+        max(load - generation, 0), with no tier credit for a monthly surplus.
+        Without `monthly_load_kwh` consumption is taken to equal generation,
+        so generation offsets the cheapest tiers; since tier rates rise with
+        use, that is a lower bound whenever consumption exceeds generation.
+        """
+        rows = np.asarray(rows)
+        annual_kwh = np.broadcast_to(np.asarray(annual_kwh, dtype=float), rows.shape)
+        lat = np.broadcast_to(np.asarray(lat, dtype=float), rows.shape)
+        if monthly_load_kwh is not None:
+            monthly_load_kwh = np.broadcast_to(np.asarray(monthly_load_kwh, dtype=float), rows.shape)
+        savings = np.empty(len(rows))
+        for start in range(0, len(rows), TARIFF_CHUNK_SITES):
+            block = slice(start, start + TARIFF_CHUNK_SITES)
+            block_rows = rows[block]
+            gen = hourly_generation_profile(annual_kwh[block], lat[block])
+            rates = self.hour_rates[block_rows[:, None], _IS_WEEKEND, _HOUR_OF_DAY]
+            energy = (rates * gen).sum(axis=1)
+
+            gen_monthly = np.add.reduceat(gen, _MONTH_STARTS, axis=1)
+            if monthly_load_kwh is None:
+                load_monthly = gen_monthly
+            else:
+                load_monthly = np.broadcast_to(monthly_load_kwh[block][:, None], gen_monthly.shape)
+            net_import = np.clip(load_monthly - gen_monthly, 0, None)
+            tiered = (self._tier_costs(block_rows, load_monthly)
+                      - self._tier_costs(block_rows, net_import))
+            savings[block] = energy + tiered
+        return savings
+
+
+def hourly_generation_profile(annual_kwh, lat):
+    """Spread annual energy over 8760 hours following clear-sky sun elevation.
+
+    `annual_kwh` and `lat` are per-site arrays; returns (n_sites, 8760).
+    """
+    annual_kwh = np.atleast_1d(np.asarray(annual_kwh, dtype=float))
+    phi = np.radians(np.atleast_1d(np.asarray(lat, dtype=float)))[:, None]
+    decl = np.radians(23.44) * np.sin(2 * np.pi * (284 + _DAY_OF_YEAR + 1) / 365)
+    hour_angle = np.radians(15.0 * (_HOUR_OF_DAY + 0.5 - 12))
+    cos_zenith = np.sin(phi) * np.sin(decl) + np.cos(phi) * np.cos(decl) * np.cos(hour_angle)
+    weights = np.clip(cos_zenith, 0, None)
+    total = weights.sum(axis=1, keepdims=True)
+    return weights / np.where(total > 0, total, 1) * annual_kwh[:, None]
+
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def _load_tariff_book(path, mtime_ns):
+    tariffs = []
+    if path is not None:
+        with open(path) as f:
+            tariffs = json.load(f)["tariffs"]
+    averages = [
+        {"id": f"avg-{country}", "country": country, "name": "Country average", "base_rate": rate}
+        for country, rate in ELECTRICITY_RATES.items()
+    ]
+    averages.append({"id": "avg-default", "name": "Default average", "base_rate": DEFAULT_RATE})
+    return TariffBook(tariffs + averages)
+
+
+def load_tariff_book():
+    """Tariffs from TARIFFS_PATH plus flat country averages, cached per mtime."""
+    try:
+        mtime = os.stat(TARIFFS_PATH).st_mtime_ns
+    except OSError:
+        return _load_tariff_book(None, None)
+    return _load_tariff_book(TARIFFS_PATH, mtime)
+
+
+# ============== AUDIT LOG ==============
+# Every predict / calculate event is queued here and written by a background
+# thread in batches, so logging never blocks a rerun. Files rotate by size and
+# only the newest AUDIT_MAX_FILES are kept; if the queue is full (writer
+# stalled) entries are dropped, not waited on.
+AUDIT_DIR = "logs"
+AUDIT_BATCH_SIZE = 200          # entries per write
+AUDIT_FLUSH_SECONDS = 2.0       # max delay before a partial batch is written
+AUDIT_MAX_BYTES = 10 * 1024 * 1024
+AUDIT_MAX_FILES = 50            # oldest rotated files beyond this are deleted
+AUDIT_QUEUE_SIZE = 10000
+
+
+class AuditLog:
+    """Asynchronous, batched JSONL writer with size-based rotation."""
+
+    def __init__(self, directory=AUDIT_DIR):
+        self.directory = directory
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=AUDIT_QUEUE_SIZE)
+        self._path = None
+        self._thread = threading.Thread(target=self._run, name="audit-log", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, event, **fields):
+        entry = {"ts": datetime.utcnow().isoformat(), "event": event, **fields}
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Flush queued entries and stop the writer thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + AUDIT_FLUSH_SECONDS
+        while True:
+            try:
+                entry = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                entry = ()
+            if entry is None or len(batch) >= AUDIT_BATCH_SIZE or time.monotonic() >= deadline:
+                self._write(batch)
+                batch = []
+                deadline = time.monotonic() + AUDIT_FLUSH_SECONDS
+            if entry is None:
+                return
+            if entry:
+                batch.append(entry)
+
+    def _write(self, batch):
+        if not batch:
+            return
+        try:
+            if self._path is None or os.path.getsize(self._path) >= AUDIT_MAX_BYTES:
+                os.makedirs(self.directory, exist_ok=True)
+                stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S-%f")
+                self._path = os.path.join(self.directory, f"audit-{stamp}.jsonl")
+                self._prune()
+            with open(self._path, "a") as f:
+                f.write("".join(json.dumps(e, default=str) + "\n" for e in batch))
+        except OSError:
+            self.dropped += len(batch)
+
+    def _prune(self):
+        """Keep room for the new file within AUDIT_MAX_FILES (names sort by time)."""
+        files = sorted(glob.glob(os.path.join(self.directory, "audit-*.jsonl")))
+        for path in files[:max(len(files) - (AUDIT_MAX_FILES - 1), 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+@st.cache_resource(show_spinner=False)
+def get_audit_log():
+    """One writer thread per process, shared by all sessions."""
+    return AuditLog()
+
+
+def summarize_audit_log(directory=AUDIT_DIR, top=10):
+    """Offline summary of the audit files in `directory`.
+
+    Returns a dict of DataFrames: hot cities, hot input regions (binned
+    prediction inputs), latency percentiles and cache hit rate per event.
+    Empty dict if there is nothing logged yet.
+    """
+    files = sorted(glob.glob(os.path.join(directory, "audit-*.jsonl")))
+    if not files:
+        return {}
+    records = []
+    for path in files:
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue  # partly written tail of the file being appended to
+    log = pd.DataFrame(records)
+    if log.empty:
+        return {}
+
+    summary = {}
+    cities = log.dropna(subset=["city"]) if "city" in log else log.iloc[:0]
+    if not cities.empty:
+        summary["hot_cities"] = (
+            cities.groupby(["city", "event"]).size().unstack(fill_value=0)
+            .assign(Total=lambda d: d.sum(axis=1))
+            .sort_values("Total", ascending=False).head(top)
+        )
+
+    predicts = log[log["event"] == "predict"]
+    if not predicts.empty:
+        inputs = pd.json_normalize(predicts["inputs"].tolist())
+        regions = pd.DataFrame({
+            "Hour": inputs["Hour"].astype(int),
+            "Temperature (5°C)": (inputs["Temperature"] // 5 * 5).astype(int),
+            "Humidity (10%)": (inputs["Relative Humidity"] // 10 * 10).astype(int),
+        })
+        summary["hot_regions"] = (
+            regions.value_counts().rename("Requests").reset_index().head(top)
+        )
+
+    latency = log.groupby("event")["latency_ms"]
+    summary["latency"] = pd.DataFrame({
+        "Count": latency.size(),
+        "p50 (ms)": latency.quantile(0.50),
+        "p90 (ms)": latency.quantile(0.90),
+        "p99 (ms)": latency.quantile(0.99),
+        "Cache hit rate": log.get("cache_hit", pd.Series(np.nan, index=log.index))
+                             .astype(float).groupby(log["event"]).mean(),
+    })
+    return summary
+
+
+# ============== PORTFOLIO ==============
+# Bulk site analysis: weather is fetched concurrently through a short-lived
+# process-wide cache (coordinates rounded so neighbouring sites share a
+# request), then prediction, sizing and savings run vectorized per chunk.
+PORTFOLIO_CHUNK_ROWS = 250
+PORTFOLIO_REQUIRED = ["lat", "lon", "load_w", "panel"]
+DEFAULT_COST_PER_W = 3.00    # $/W nominal, used when a site has no system_cost
+WEATHER_FETCH_WORKERS = 16
+WEATHER_CACHE_SECONDS = 600
+WEATHER_FAILURE_CACHE_SECONDS = 60  # failed lookups fall back to defaults
+WEATHER_CACHE_DECIMALS = 2   # ~1 km
+
+
+@st.cache_resource(show_spinner=False)
+def _weather_cache():
+    return {}, threading.Lock()
+
+
+def fetch_weather_many(lats, lons):
+    """Current weather for many coordinates; list aligned with the inputs."""
+    cache, lock = _weather_cache()
+    keys = [(round(float(a), WEATHER_CACHE_DECIMALS), round(float(b), WEATHER_CACHE_DECIMALS))
+            for a, b in zip(lats, lons)]
+    now = time.monotonic()
+    with lock:
+        fresh = {k: v for k, (expires, v) in cache.items() if expires > now}
+    missing = [k for k in dict.fromkeys(keys) if k not in fresh]
+    if missing:
+        with ThreadPoolExecutor(WEATHER_FETCH_WORKERS) as pool:
+            fetched = list(pool.map(lambda k: fetch_weather_data(k[0], k[1], None), missing))
+        with lock:
+            for k in [k for k, (expires, _) in cache.items() if expires <= now]:
+                del cache[k]
+            for k, data in zip(missing, fetched):
+                ttl = WEATHER_CACHE_SECONDS if data is not None else WEATHER_FAILURE_CACHE_SECONDS
+                cache[k] = (now + ttl, data)
+        fresh.update(zip(missing, fetched))
+    return [fresh[k] for k in keys]
+
+
+def weather_features(weather):
+    """Model features from OpenWeatherMap responses (None → page defaults)."""
+    main = pd.json_normalize([w or {} for w in weather])
+
+    def col(name, default):
+        return main[name].fillna(default) if name in main else pd.Series(default, index=main.index)
+
+    humidity = col("main.humidity", 46)
+    temperature = col("main.temp", 302.15) - 273.15
+    tz_offset = col("timezone", 0)
+    return pd.DataFrame({
+        "Hour": ((time.time() + tz_offset) // 3600 % 24).astype(int),
+        "Temperature": temperature,
+        "Dew Point": temperature - (100 - humidity) / 5.,
+        "Relative Humidity": humidity,
+        "Surface Albedo": 0.15,
+        "Pressure": col("main.pressure", 986),
+        "Wind Speed": col("wind.speed", 2.9),
+    })
+
+
+def nearest_country(lats, lons, max_degrees=5.0):
+    """Country of the nearest MAJOR_CITIES entry, '' if none is close."""
+    cities = pd.DataFrame(MAJOR_CITIES)
+    d = np.hypot(np.subtract.outer(np.asarray(lats, float), cities["lat"].values),
+                 np.subtract.outer(np.asarray(lons, float), cities["lon"].values))
+    nearest = d.argmin(axis=1)
+    return np.where(d.min(axis=1) <= max_degrees, cities["country"].values[nearest], "")
+
+
+def analyze_sites(sites, model, tariff_book):
+    """Predict GHI and size / price a system for every row of `sites`.
+
+    Rows with an unknown panel, a non-numeric or out-of-range value get a
+    Status message instead of results. Rows whose weather lookup failed are
+    predicted from the Prediction page defaults and flagged as such; only
+    "ok" rows are meant to count towards totals.
+    """
+    out = sites.reset_index(drop=True).copy()
+    for name in ("lat", "lon", "load_w", "peak_sun_hours", "system_cost"):
+        if name in out:
+            out[name] = pd.to_numeric(out[name], errors="coerce")
+    panels = pd.DataFrame(PANEL_BRANDS).dropna().set_index("Brand")
+    valid = (out["lat"].between(-90, 90) & out["lon"].between(-180, 180)
+             & out["load_w"].gt(0) & out["panel"].isin(panels.index))
+    out["Status"] = np.where(valid, "ok", "invalid lat/lon, load or panel")
+    ok = out[valid]
+    if ok.empty:
+        return out
+
+    weather = fetch_weather_many(ok["lat"], ok["lon"])
+    features = weather_features(weather)
+    pred = model.predict_with_uncertainty(features[FEATURE_NAMES].values)
+
+    spec = panels.loc[ok["panel"]].reset_index(drop=True)
+    peak_hours = ok.get("peak_sun_hours", pd.Series(5.0, index=ok.index)).fillna(5.0).values
+    ghi = pred["GHI"].values
+    ppp = ghi * spec["Area (m²)"].values * spec["Efficiency (%)"].values / 100.0 * DEFAULT_DERATE
+    with np.errstate(divide="ignore", invalid="ignore"):
+        n = np.where(ppp > 0, np.ceil(ok["load_w"].values / ppp), np.nan)
+    e_total = ppp / 1000 * peak_hours * 365 * n
+    default_cost = DEFAULT_COST_PER_W * n * spec["Nominal Power (W)"].values
+    cost = ok.get("system_cost", pd.Series(np.nan, index=ok.index)).fillna(
+        pd.Series(default_cost, index=ok.index)).values
+
+    # Blank or missing countries fall back to the nearest known city's.
+    country = nearest_country(ok["lat"], ok["lon"])
+    if "country" in ok:
+        given = ok["country"].fillna("").astype(str).str.strip().values
+        country = np.where(given == "", country, given)
+    rows = [tariff_book.default_row(c) for c in country]
+    savings = tariff_book.annual_savings(rows, np.nan_to_num(e_total), ok["lat"].values)
+
+    results = pd.DataFrame({
+        "GHI (W/m²)": ghi, "GHI P10": pred["GHI P10"].values, "GHI P90": pred["GHI P90"].values,
+        "Confidence": pred["Confidence"].values, "Panels": n,
+        "System Power (W)": n * ppp, "Annual Energy (kWh)": e_total,
+        "Annual Savings ($)": savings, "System Cost ($)": cost,
+        "Payback (yr)": np.where(savings > 0, cost / np.where(savings > 0, savings, 1), np.nan),
+    }, index=ok.index)
+    out = out.join(results)
+    no_weather = ok.index[[w is None for w in weather]]
+    out.loc[no_weather, "Status"] = "weather unavailable (defaults used)"
+    return out
+
+
 # ============== PAGE: HOME ==============
 def page_home():
     st.title("Solar Radiation Prediction App")
@@ -283,6 +1025,8 @@ def page_prediction():
         st.session_state.selected_city = {"name": "Menlo Park", "lat": 37.4530, "lon": -122.1817}
     if "predicted_ghi" not in st.session_state:
         st.session_state.predicted_ghi = None
+    if "ghi_uncertainty" not in st.session_state:
+        st.session_state.ghi_uncertainty = None
 
     # ── Build deduplicated city list (needed in both columns) ──────────────
     seen_names: set = set()
@@ -403,7 +1147,6 @@ def page_prediction():
             pressure       = st.number_input("Pressure (hPa)",      min_value=800, max_value=1100,   value=int(default_pressure),       key="pressure")
             wind_speed     = st.number_input("Wind Speed (m/s)",    min_value=0.0, max_value=50.0,   value=float(default_wind_speed),   key="wind")
 
-        feature_names = ['Hour', 'Temperature', 'Dew Point', 'Relative Humidity', 'Surface Albedo', 'Pressure', 'Wind Speed']
         df = pd.DataFrame({
             "Hour": hour, "Temperature": temperature, "Dew Point": dew_point,
             "Relative Humidity": relative_humidity, "Surface Albedo": surface_albedo,
@@ -416,13 +1159,27 @@ def page_prediction():
                 st.error("Model not loaded. Ensure `knn.pkl` exists.")
             else:
                 try:
-                    prediction = knn.predict(df[feature_names].values)
-                    st.session_state.predicted_ghi = float(prediction[0])
+                    inputs = {k: float(v) for k, v in df[FEATURE_NAMES].iloc[0].items()}
+                    started = time.perf_counter()
+                    prediction, cache_hit = knn.predict_one(inputs)
+                    get_audit_log().record(
+                        "predict", city=city, model_version=knn.version,
+                        inputs=inputs, output=prediction, cache_hit=cache_hit,
+                        latency_ms=(time.perf_counter() - started) * 1000,
+                    )
+                    st.session_state.predicted_ghi = float(prediction["GHI"])
+                    st.session_state.ghi_uncertainty = prediction
                 except Exception as e:
                     st.error(f"Prediction failed: {e}")
 
         if st.session_state.predicted_ghi is not None:
             st.success(f"### {st.session_state.predicted_ghi:.2f} W/m²  — Predicted GHI")
+            u = st.session_state.ghi_uncertainty
+            if u:
+                st.caption(
+                    f"Neighbour range (P10–P90): {u['GHI P10']:.0f}–{u['GHI P90']:.0f} W/m² · "
+                    f"±{u['GHI Std']:.0f} W/m² std · confidence {u['Confidence']:.0%}"
+                )
             st.caption("Head to the Calculator page to size your solar panel system.")
         else:
             st.info("Click **Predict GHI** to generate a prediction.")
@@ -441,13 +1198,7 @@ def page_calculator():
     if "calc_results" not in st.session_state:
         st.session_state.calc_results = None
 
-    brands = [
-        {"Brand": "SunPower",      "Efficiency (%)": 22.8, "Area (m²)": 1.63, "Nominal Power (W)": 430},
-        {"Brand": "LG",            "Efficiency (%)": 20.4, "Area (m²)": 1.70, "Nominal Power (W)": 400},
-        {"Brand": "Panasonic",     "Efficiency (%)": 20.3, "Area (m²)": 1.70, "Nominal Power (W)": 405},
-        {"Brand": "Jinko (Generic)","Efficiency (%)": 18.4, "Area (m²)": 1.70, "Nominal Power (W)": 375},
-        {"Brand": "Custom",        "Efficiency (%)": None,  "Area (m²)": None,  "Nominal Power (W)": None},
-    ]
+    brands = PANEL_BRANDS
     brands_df = pd.DataFrame(brands)
 
     left, right = st.columns([1, 1])
@@ -474,7 +1225,7 @@ def page_calculator():
             nominal_power    = float(row["Nominal Power (W)"])
             st.caption(f"Efficiency {panel_efficiency}% · Area {panel_area} m² · {nominal_power:.0f} W nominal")
 
-        derate = st.slider("System Derate Factor", 0.5, 1.0, 0.77, 0.01, key="derate",
+        derate = st.slider("System Derate Factor", 0.5, 1.0, DEFAULT_DERATE, 0.01, key="derate",
                            help="Accounts for inverter, wiring, temperature losses. Typical: 0.77",
                            disabled=True)
 
@@ -495,8 +1246,30 @@ def page_calculator():
         if st.session_state.get("_last_rate_city") != city_name:
             st.session_state["_last_rate_city"] = city_name
             st.session_state["electricity_rate"] = float(auto_rate)
-        rate_label = f"Electricity rate ($/kWh) — {country} avg" if country else "Electricity rate ($/kWh)"
-        electricity_rate = st.number_input(rate_label, 0.0, value=float(auto_rate), key="electricity_rate")
+        # Utility tariffs for the country (TOU / tiered) replace the flat rate
+        # when selected; the country average stays editable as before.
+        try:
+            tariff_book = load_tariff_book()
+        except Exception as e:
+            tariff_book = None
+            st.error(f"Failed to load tariffs: {e}")
+        tariff_rows = [r for r in (tariff_book.by_country.get(country, []) if tariff_book else [])
+                       if r != tariff_book.default_row(country)]
+        tariff_row = st.selectbox(
+            "Tariff", [None] + tariff_rows, key="tariff_select",
+            format_func=lambda r: "Country average (flat)" if r is None else tariff_book.label(r),
+        )
+        if tariff_row is None:
+            rate_label = f"Electricity rate ($/kWh) — {country} avg" if country else "Electricity rate ($/kWh)"
+            electricity_rate = st.number_input(rate_label, 0.0, value=float(auto_rate), key="electricity_rate")
+        monthly_load = 0.0
+        if tariff_row is not None and tariff_book.is_tiered(tariff_row):
+            monthly_load = st.number_input(
+                "Monthly consumption (kWh)", 0.0, value=0.0, key="monthly_load",
+                help="Tiered tariff: solar offsets the top of your monthly consumption. "
+                     "Leave at 0 to assume consumption equals generation, which understates "
+                     "savings if you use more than the system produces.",
+            )
 
         system_cost = st.number_input("Installation cost ($)", 0.0, value=8000.0, key="system_cost")
 
@@ -508,6 +1281,21 @@ def page_calculator():
             if not ghi_value or ghi_value <= 0:
                 st.error("GHI must be > 0.")
             else:
+                inputs = {
+                    "city": city_name, "country": country, "lat": selected_city.get("lat"),
+                    "ghi": ghi_value, "required_power": required_power,
+                    "panel_efficiency": panel_efficiency, "panel_area": panel_area,
+                    "derate": derate, "peak_sun_hours": peak_sun_hours,
+                    "system_cost": system_cost,
+                    "electricity_rate": electricity_rate if tariff_row is None else None,
+                    "tariff": None if tariff_row is None else tariff_book.meta.at[tariff_row, "id"],
+                    "monthly_load": monthly_load,
+                }
+                started = time.perf_counter()
+                # Logged as cache_hit: inputs identical to the last calculation,
+                # i.e. a result a cache could have served.
+                prev = st.session_state.calc_results
+                repeat = prev is not None and prev.get("inputs") == inputs
                 try:
                     ppp = ghi_value * panel_area * (panel_efficiency / 100.0) * derate
                     if ppp <= 0:
@@ -518,7 +1306,14 @@ def page_calculator():
                         sys_power  = n * ppp
                         e_per_year = (ppp / 1000) * peak_sun_hours * 365
                         e_total    = e_per_year * n
-                        savings    = e_total * electricity_rate
+                        if tariff_row is None:
+                            savings = e_total * electricity_rate
+                        else:
+                            savings = float(tariff_book.annual_savings(
+                                [tariff_row], e_total, selected_city.get("lat", 0.0),
+                                monthly_load_kwh=monthly_load or None,
+                            )[0])
+                            electricity_rate = round(savings / e_total, 3) if e_total > 0 else 0.0
                         payback    = (system_cost / savings) if savings > 0 else None
                         st.session_state.calc_results = {
                             "ghi": ghi_value, "ppp": ppp, "n": n,
@@ -526,7 +1321,16 @@ def page_calculator():
                             "e_total": e_total, "e_per_year": e_per_year,
                             "savings": savings, "payback": payback,
                             "electricity_rate": electricity_rate,
+                            "tariff": None if tariff_row is None else tariff_book.label(tariff_row),
+                            "savings_lower_bound": (tariff_row is not None and not monthly_load
+                                                    and tariff_book.is_tiered(tariff_row)),
+                            "inputs": inputs,
                         }
+                        get_audit_log().record(
+                            "calculate", city=city_name, inputs=inputs, cache_hit=repeat,
+                            output={"n": n, "e_total": e_total, "savings": savings, "payback": payback},
+                            latency_ms=(time.perf_counter() - started) * 1000,
+                        )
                 except Exception as e:
                     st.error(f"Calculation failed: {e}")
 
@@ -553,7 +1357,177 @@ def page_calculator():
             st.caption(
                 f"Per-panel: {r['ppp']:.1f} W · {r['e_per_year']:,.0f} kWh/yr  |  "
                 f"GHI: {r['ghi']:.0f} W/m²  |  Rate: ${r['electricity_rate']}/kWh"
+                + (f" effective ({r['tariff']})" if r.get("tariff") else "")
             )
+            if r.get("savings_lower_bound"):
+                st.caption("Tiered tariff with no monthly consumption given: assumes consumption "
+                           "equals generation, so savings are a lower bound if you use more.")
+
+
+# ============== PAGE: MODEL DATA ==============
+def page_model_data():
+    st.markdown("# 🧪 Model Training Data")
+
+    if knn is None:
+        st.error("Model not loaded. Ensure `knn.pkl` exists.")
+        return
+
+    m1, m2, m3 = st.columns(3)
+    m1.metric("Model Version", knn.version)
+    m2.metric("Indexed Samples", f"{knn.n_base:,}")
+    m3.metric("Pending (unindexed) Samples", f"{knn.n_delta:,}")
+    st.caption(
+        f"New measurements are added to the live model immediately; the neighbour "
+        f"index is rebuilt once {COMPACT_THRESHOLD:,} samples are pending."
+    )
+
+    st.subheader("Add ground-truth measurements")
+    st.caption("CSV columns: " + ", ".join(FEATURE_NAMES + [TARGET_NAME]))
+    upload = st.file_uploader("Measurements CSV", type="csv", key="training_upload")
+    if upload is None:
+        return
+
+    try:
+        samples = pd.read_csv(upload)
+    except Exception as e:
+        st.error(f"Could not read CSV: {e}")
+        return
+
+    missing = [c for c in FEATURE_NAMES + [TARGET_NAME] if c not in samples.columns]
+    if missing:
+        st.error(f"Missing columns: {', '.join(missing)}")
+        return
+    # Non-numeric values become NaN and those rows are dropped.
+    samples = samples[FEATURE_NAMES + [TARGET_NAME]].apply(pd.to_numeric, errors="coerce").dropna()
+    st.dataframe(samples.head(20), use_container_width=True)
+
+    if st.button(f"➕ Add {len(samples):,} samples to model", key="publish_btn",
+                 use_container_width=True, disabled=samples.empty):
+        try:
+            model = publish_samples(samples)
+            st.success(f"Published model version {model.version}.")
+        except Exception as e:
+            st.error(f"Update failed: {e}")
+
+
+# ============== PAGE: PORTFOLIO ==============
+def page_portfolio():
+    st.markdown("# 🗂️ Portfolio Analysis")
+    st.caption(
+        "Upload a CSV of sites with columns " + ", ".join(f"`{c}`" for c in PORTFOLIO_REQUIRED)
+        + " (optional: `name`, `country`, `peak_sun_hours`, `system_cost`). "
+        + f"Missing system costs default to ${DEFAULT_COST_PER_W:.2f}/W of nominal panel capacity. "
+        + "Panel must be one of: " + ", ".join(b["Brand"] for b in PANEL_BRANDS if b["Brand"] != "Custom")
+    )
+
+    if knn is None:
+        st.error("Model not loaded. Ensure `knn.pkl` exists.")
+        return
+
+    upload = st.file_uploader("Sites CSV", type="csv", key="portfolio_upload")
+    if upload is None:
+        return
+    try:
+        sites = pd.read_csv(upload)
+    except Exception as e:
+        st.error(f"Could not read CSV: {e}")
+        return
+    missing = [c for c in PORTFOLIO_REQUIRED if c not in sites.columns]
+    if missing:
+        st.error(f"Missing columns: {', '.join(missing)}")
+        return
+
+    # Finished chunks live in session state, so a rerun triggered mid-run
+    # (any widget interaction) resumes at the next chunk instead of restarting.
+    run_key = (upload.name, upload.size)
+    state = st.session_state.get("portfolio")
+    if state is None or state["key"] != run_key:
+        state = st.session_state.portfolio = {"key": run_key, "chunks": [], "running": False, "elapsed": 0.0}
+
+    if st.button(f"▶️ Analyze {len(sites):,} sites", key="portfolio_btn", use_container_width=True):
+        state.update(chunks=[], running=True, elapsed=0.0)
+
+    done_rows = sum(len(c) for c in state["chunks"])
+    progress = st.progress(done_rows / max(len(sites), 1), text=f"{done_rows:,} / {len(sites):,} sites")
+    table = st.empty()
+    if state["chunks"]:
+        table.dataframe(pd.concat(state["chunks"], ignore_index=True), use_container_width=True)
+
+    if state["running"]:
+        tariff_book = load_tariff_book()
+        for start in range(done_rows, len(sites), PORTFOLIO_CHUNK_ROWS):
+            started = time.perf_counter()
+            try:
+                chunk = analyze_sites(sites.iloc[start:start + PORTFOLIO_CHUNK_ROWS], knn, tariff_book)
+            except Exception as e:
+                state["running"] = False
+                st.error(f"Analysis failed at site {start + 1:,}: {e}")
+                return
+            state["elapsed"] += time.perf_counter() - started
+            state["chunks"].append(chunk)
+            done_rows += len(chunk)
+            progress.progress(done_rows / len(sites), text=f"{done_rows:,} / {len(sites):,} sites")
+            table.dataframe(pd.concat(state["chunks"], ignore_index=True), use_container_width=True)
+        state["running"] = False
+        get_audit_log().record(
+            "portfolio", model_version=knn.version, inputs={"sites": len(sites)},
+            output={"ok": int(sum((c["Status"] == "ok").sum() for c in state["chunks"]))},
+            latency_ms=state["elapsed"] * 1000,
+        )
+
+    if state["chunks"] and not state["running"]:
+        results = pd.concat(state["chunks"], ignore_index=True)
+        ok = results[results["Status"] == "ok"]
+        m1, m2, m3, m4 = st.columns(4)
+        m1.metric("Sites", f"{len(ok):,} / {len(results):,}")
+        m2.metric("Panels", f"{ok['Panels'].sum():,.0f}")
+        m3.metric("Annual Energy", f"{ok['Annual Energy (kWh)'].sum():,.0f} kWh")
+        m4.metric("Annual Savings", f"${ok['Annual Savings ($)'].sum():,.0f}")
+        no_weather = (results["Status"] == "weather unavailable (defaults used)").sum()
+        if no_weather:
+            st.warning(f"{no_weather:,} sites used default weather because the lookup failed; "
+                       "they are excluded from the totals. Re-run in a minute to retry them.")
+        st.download_button(
+            "⬇️ Download results CSV", results.to_csv(index=False).encode(),
+            file_name="portfolio_results.csv", mime="text/csv", use_container_width=True,
+        )
+
+
+# ============== PAGE: USAGE ==============
+def page_usage():
+    st.markdown("# 📊 Usage Summary")
+    st.caption(f"Summarised from the audit log in `{AUDIT_DIR}/` (written every "
+               f"{AUDIT_FLUSH_SECONDS:g}s or {AUDIT_BATCH_SIZE} events).")
+
+    try:
+        summary = summarize_audit_log()
+    except Exception as e:
+        st.error(f"Failed to read audit log: {e}")
+        return
+    if not summary:
+        st.info("No predictions or calculations logged yet.")
+        return
+
+    st.subheader("Latency and cache hits")
+    st.dataframe(summary["latency"], use_container_width=True)
+
+    left, right = st.columns(2)
+    with left:
+        st.subheader("Hot cities")
+        if "hot_cities" in summary:
+            st.dataframe(summary["hot_cities"], use_container_width=True)
+        else:
+            st.info("No city-level events logged yet.")
+    with right:
+        st.subheader("Hot input regions")
+        if "hot_regions" in summary:
+            st.dataframe(summary["hot_regions"], use_container_width=True, hide_index=True)
+        else:
+            st.info("No predictions logged yet.")
+
+    dropped = get_audit_log().dropped
+    if dropped:
+        st.warning(f"{dropped:,} audit entries were dropped by this process (writer backlog).")
 
 
 # ============== PAGE: ABOUT ==============
@@ -689,7 +1663,10 @@ def page_about():
         st.markdown("""
         The model's accuracy depends on the training data quality and the accuracy of weather data.
         Predictions are best during clear weather conditions. Cloudy and extreme weather conditions
-        may have higher uncertainty. Use the override GHI feature to test different scenarios.
+        may have higher uncertainty. Each prediction shows the P10–P90 range of the neighbours' GHI
+        and a confidence score based on how close those neighbours are to your inputs; a wide
+        range or low confidence means similar conditions are rare in the training data.
+        Use the override GHI feature to test different scenarios.
         """)
     
     with st.expander("Can I use this for my roof?"):
@@ -738,6 +1715,9 @@ def main():
         "Home": page_home,
         "Prediction": page_prediction,
         "Calculator": page_calculator,
+        "Portfolio": page_portfolio,
+        "Model Data": page_model_data,
+        "Usage": page_usage,
         "About": page_about,
     }
     